@@ -5,7 +5,8 @@
 Extracts annotations from a PDF file in markdown format for use in reviewing.
 """
 
-import sys, io, textwrap, argparse
+import sys, io, os, bisect, statistics, textwrap, argparse
+import concurrent.futures
 sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
 from pdfminer.pdfinterp import PDFResourceManager, PDFPageInterpreter
 from pdfminer.pdfpage import PDFPage
@@ -19,6 +20,11 @@ import pdfminer.settings
 import pdfminer.utils
 import pypandoc
 
+try:
+    import ahocorasick # optional, speeds up matching many tags
+except ImportError:
+    ahocorasick = None
+
 pdfminer.settings.STRICT = False
 
 SUBSTITUTIONS = {
@@ -33,54 +39,96 @@ SUBSTITUTIONS = {
     u'”': '"',
     u'…': '...',
 }
+SUBSTITUTIONS_TABLE = str.maketrans(SUBSTITUTIONS)
 
 ANNOT_SUBTYPES = frozenset({'Text', 'Highlight', 'Squiggly', 'StrikeOut', 'Underline'})
 ANNOT_NITS = frozenset({'Squiggly', 'StrikeOut', 'Underline'})
 
 COLUMNS_PER_PAGE = 1 # default only, changed via a command-line parameter
 
-DEBUG_BOXHIT = False
+MIN_PARALLEL_PAGES = 8 # fewest annotated pages worth starting worker processes for
 
-def boxhit(item, box):
-    (x0, y0, x1, y1) = box
-    assert item.x0 <= item.x1 and item.y0 <= item.y1
-    assert x0 <= x1 and y0 <= y1
+MIN_STRIPE_HEIGHT = 1 # minimum height (in points) of the page stripes used to index annotation boxes
+MAX_BOX_STRIPES = 4 # boxes spanning more stripes than this are not indexed, but always tested
 
+def boxhit(ix0, iy0, ix1, iy1, bx0, by0, bx1, by1):
     # does most of the item area overlap the box?
     # http://math.stackexchange.com/questions/99565/simplest-way-to-calculate-the-intersect-area-of-two-rectangles
-    x_overlap = max(0, min(item.x1, x1) - max(item.x0, x0))
-    y_overlap = max(0, min(item.y1, y1) - max(item.y0, y0))
-    overlap_area = x_overlap * y_overlap
-    item_area = (item.x1 - item.x0) * (item.y1 - item.y0)
-    assert overlap_area <= item_area
-
-    if DEBUG_BOXHIT and overlap_area != 0:
-        print("'%s' %f-%f,%f-%f in %f-%f,%f-%f %2.0f%%" %
-              (item.get_text(), item.x0, item.x1, item.y0, item.y1, x0, x1, y0, y1,
-               100 * overlap_area / item_area))
-
-    if item_area == 0:
+    # (this is the innermost loop of text extraction, so it avoids calls and divisions)
+    x_overlap = (ix1 if ix1 < bx1 else bx1) - (ix0 if ix0 > bx0 else bx0)
+    if x_overlap <= 0:
         return False
-    else:
-        return overlap_area >= 0.5 * item_area
+    y_overlap = (iy1 if iy1 < by1 else by1) - (iy0 if iy0 > by0 else by0)
+    if y_overlap <= 0:
+        return False
+    item_area = (ix1 - ix0) * (iy1 - iy0)
+    return item_area > 0 and 2 * x_overlap * y_overlap >= item_area
 
 class RectExtractor(TextConverter):
     def __init__(self, rsrcmgr, codec='utf-8', pageno=1, laparams=None):
         dummy = io.StringIO()
         TextConverter.__init__(self, rsrcmgr, outfp=dummy, codec=codec, pageno=pageno, laparams=laparams)
         self.annots = set()
+        self._index = {}
+        self._tallboxes = []
+        self._stripeheight = MIN_STRIPE_HEIGHT
 
     def setannots(self, annots):
         self.annots = {a for a in annots if a.boxes}
 
+        # Index the annotation boxes by the horizontal stripes of the page that
+        # they cover, so that each item is only hit-tested against the boxes
+        # near it rather than every box on the page. Boxes are typically one
+        # line of text high, so that is the height of a stripe.
+        self._index = {}
+        self._tallboxes = []
+        if self.annots:
+            heights = [b[3] - b[1] for a in self.annots for b in a.boxes]
+            self._stripeheight = max(statistics.median(heights), MIN_STRIPE_HEIGHT)
+        # Each stripe also records the horizontal extent of its boxes, so that
+        # items beside them can be rejected without testing any box. Unusually
+        # tall (e.g. malformed) boxes would need too many stripes, so they are
+        # kept aside and tested against every item.
+        for a in self.annots:
+            for (x0, y0, x1, y1) in a.boxes:
+                entry = (x0, y0, x1, y1, a)
+                first = int(y0 // self._stripeheight)
+                last = int(y1 // self._stripeheight)
+                if last - first >= MAX_BOX_STRIPES:
+                    self._tallboxes.append(entry)
+                    continue
+                for stripe in range(first, last + 1):
+                    bucket = self._index.get(stripe)
+                    if bucket is None:
+                        self._index[stripe] = [x0, x1, [entry]]
+                    else:
+                        if x0 < bucket[0]: bucket[0] = x0
+                        if x1 > bucket[1]: bucket[1] = x1
+                        bucket[2].append(entry)
+
     # main callback from parent PDFConverter
     def receive_layout(self, ltpage):
-        self._lasthit = frozenset()
+        if not self.annots:
+            return
+        self._lasthit = []
         self._curline = set()
         self.render(ltpage)
 
     def testboxes(self, item):
-        hits = frozenset({a for a in self.annots if any({boxhit(item, b) for b in a.boxes})})
+        (x0, y0, x1, y1) = (item.x0, item.y0, item.x1, item.y1)
+        hits = []
+        if self._index:
+            # A box that covers most of the item must span at least half of its
+            # height, and therefore its vertical centre, so we need only check
+            # the boxes in the centre's stripe.
+            bucket = self._index.get(int((y0 + y1) / 2 // self._stripeheight))
+            if bucket is not None and x1 > bucket[0] and x0 < bucket[1]:
+                for (bx0, by0, bx1, by1, a) in bucket[2]:
+                    if a not in hits and boxhit(x0, y0, x1, y1, bx0, by0, bx1, by1):
+                        hits.append(a)
+        for (bx0, by0, bx1, by1, a) in self._tallboxes:
+            if a not in hits and boxhit(x0, y0, x1, y1, bx0, by0, bx1, by1):
+                hits.append(a)
         self._lasthit = hits
         self._curline.update(hits)
         return hits
@@ -93,35 +141,59 @@ class RectExtractor(TextConverter):
             a.capture('\n')
         self._curline = set()
 
-    def render(self, item):
-        # If it's a container, recurse on nested items.
-        if isinstance(item, LTContainer):
-            for child in item:
-                self.render(child)
+    def render(self, ltpage):
+        # Walk the layout tree depth-first with an explicit stack, rather than
+        # recursing, to avoid a Python call per item.
+        stack = [ltpage]
+        while stack:
+            item = stack.pop()
+            # Characters are by far the most common items, and neither they
+            # nor LTAnno are subclassed, so dispatch on their exact type
+            # (which is cheaper than isinstance) before testing for containers.
+            t = type(item)
+
+            # Each character is represented by one LTChar, and we must handle
+            # individual characters (not higher-level objects like LTTextLine)
+            # so that we can capture only those covered by the annotation boxes.
+            if t is LTChar:
+                for a in self.testboxes(item):
+                    a.capture(item.get_text())
+
+            # Annotations capture whitespace not explicitly encoded in
+            # the text. They don't have an (X,Y) position, so we need some
+            # heuristics to match them to the nearby annotations.
+            elif t is LTAnno:
+                text = item.get_text()
+                if text == '\n':
+                    self.capture_newline()
+                else:
+                    for a in self._lasthit:
+                        a.capture(text)
 
-            # Text boxes are a subclass of container, and somehow encode newlines
-            # (this weird logic is derived from pdfminer.converter.TextConverter)
-            if isinstance(item, LTTextBox):
-                self.testboxes(item)
+            # All the items nested in a text box have been visited.
+            elif t is TextBoxEnd:
+                self.testboxes(item.textbox)
                 self.capture_newline()
 
-        # Each character is represented by one LTChar, and we must handle
-        # individual characters (not higher-level objects like LTTextLine)
-        # so that we can capture only those covered by the annotation boxes.
-        elif isinstance(item, LTChar):
-            for a in self.testboxes(item):
-                a.capture(item.get_text())
-
-        # Annotations capture whitespace not explicitly encoded in
-        # the text. They don't have an (X,Y) position, so we need some
-        # heuristics to match them to the nearby annotations.
-        elif isinstance(item, LTAnno):
-            text = item.get_text()
-            if text == '\n':
-                self.capture_newline()
-            else:
-                for a in self._lasthit:
-                    a.capture(text)
+            # If it's a container, visit nested items in order.
+            elif isinstance(item, LTContainer):
+                # Text boxes are a subclass of container, and somehow encode newlines
+                # (this weird logic is derived from pdfminer.converter.TextConverter)
+                if isinstance(item, LTTextBox):
+                    stack.append(TextBoxEnd(item))
+                children = list(item)
+                children.reverse()
+                stack.extend(children)
+
+
+class TextBoxEnd:
+    """
+    Marks the end of a text box's children on RectExtractor.render's stack.
+    """
+    __slots__ = ('textbox',)
+
+    def __init__(self, textbox):
+        self.textbox = textbox
 
 
 class Page:
@@ -147,42 +219,43 @@ class Annotation:
             self.contents = contents
         self.rect = rect
         self.author = author
-        self.text = ''
+        self.text = [] # captured text, as a list of (non-empty) chunks
+        self._startpos = None # computed on demand by getstartpos()
 
         if coords is None:
             self.boxes = None
         else:
             assert len(coords) % 8 == 0
             self.boxes = []
-            while coords != []:
-                (x0,y0,x1,y1,x2,y2,x3,y3) = coords[:8]
-                coords = coords[8:]
-                xvals = [x0, x1, x2, x3]
-                yvals = [y0, y1, y2, y3]
+            for i in range(0, len(coords), 8):
+                xvals = coords[i:i+8:2]
+                yvals = coords[i+1:i+8:2]
                 box = (min(xvals), min(yvals), max(xvals), max(yvals))
                 self.boxes.append(box)
 
     def capture(self, text):
         if text == '\n':
             # Kludge for latex: elide hyphens
-            if self.text.endswith('-'):
-                self.text = self.text[:-1]
+            if self.text and self.text[-1].endswith('-'):
+                last = self.text.pop()[:-1]
+                if last:
+                    self.text.append(last)
 
             # Join lines, treating newlines as space, while ignoring successive
             # newlines. This makes it easier for the for the renderer to
             # "broadcast" LTAnno newlines to active annotations regardless of
             # box hits. (Detecting paragraph breaks is tricky anyway, and left
             # for future future work!)
-            elif not self.text.endswith(' '):
-                self.text += ' '
-        else:
-            self.text += text
+            elif not (self.text and self.text[-1].endswith(' ')):
+                self.text.append(' ')
+        elif text:
+            self.text.append(text)
 
     def gettext(self):
         if self.boxes:
             if self.text:
                 # replace tex ligatures (and other common odd characters)
-                return ''.join([SUBSTITUTIONS.get(c, c) for c in self.text.strip()])
+                return ''.join(self.text).strip().translate(SUBSTITUTIONS_TABLE)
             else:
                 # something's strange -- we have boxes but no text for them
                 return "(XXX: missing text!)"
@@ -190,14 +263,16 @@ class Annotation:
             return None
 
     def getstartpos(self):
-        if self.rect:
-            (x0, y0, x1, y1) = self.rect
-        elif self.boxes:
-            (x0, y0, x1, y1) = self.boxes[0]
-        else:
-            return None
-        # XXX: assume left-to-right top-to-bottom text
-        return Pos(self.page, min(x0, x1), max(y0, y1))
+        if self._startpos is None:
+            if self.rect:
+                (x0, y0, x1, y1) = self.rect
+            elif self.boxes:
+                (x0, y0, x1, y1) = self.boxes[0]
+            else:
+                return None
+            # XXX: assume left-to-right top-to-bottom text
+            self._startpos = Pos(self.page, min(x0, x1), max(y0, y1))
+        return self._startpos
 
     # custom < operator for sorting
     def __lt__(self, other):
@@ -209,26 +284,33 @@ class Pos:
         self.page = page
         self.x = x
         self.y = y
-
-    def __lt__(self, other):
-        if self.page < other.page:
-            return True
-        elif self.page == other.page:
-            assert self.page is other.page
+        self._key = None # computed on demand by sortkey()
+
+    # Positions are compared often (sorting annotations, locating outlines),
+    # so the page/column/height sort key is computed once and cached. This
+    # relies on COLUMNS_PER_PAGE and the page mediabox not changing after
+    # the first comparison.
+    def sortkey(self):
+        if self._key is None:
             # XXX: assume left-to-right top-to-bottom documents
-            (sx, sy) = self.normalise_to_mediabox()
-            (ox, oy) = other.normalise_to_mediabox()
+            (x, y) = self.normalise_to_mediabox()
             (x0, y0, x1, y1) = self.page.mediabox
             colwidth = (x1 - x0) / COLUMNS_PER_PAGE
-            self_col = (sx - x0) // colwidth
-            other_col = (ox - x0) // colwidth
-            return self_col < other_col or (self_col == other_col and sy > oy)
-        else:
-            return False
+            self._key = (self.page.pageno, (x - x0) // colwidth, -y)
+        return self._key
+
+    def __lt__(self, other):
+        return self.sortkey() < other.sortkey()
 
     def normalise_to_mediabox(self):
         x, y = self.x, self.y
         (x0, y0, x1, y1) = self.page.mediabox
+        # a missing (null) coordinate, e.g. in an /XYZ outline destination,
+        # means "unchanged"; treat it as the top-left of the page
+        if x is None:
+            x = x0
+        if y is None:
+            y = y1
         if x < x0:
             x = x0
         elif x > x1:
@@ -240,11 +322,11 @@ class Pos:
         return (x, y)
 
 
-def getannots(pdfannots, page):
+def getannots(pdfannots, page, subtypes=ANNOT_SUBTYPES):
     annots = []
     for pa in pdfannots:
         subtype = pa.get('Subtype')
-        if subtype is not None and subtype.name not in ANNOT_SUBTYPES:
+        if subtype is not None and subtype.name not in subtypes:
             continue
 
         contents = pa.get('Contents')
@@ -252,7 +334,7 @@ def getannots(pdfannots, page):
             # decode as string, normalise line endings, replace special characters
             contents = pdfminer.utils.decode_text(contents)
             contents = contents.replace('\r\n', '\n').replace('\r', '\n')
-            contents = ''.join([SUBSTITUTIONS.get(c, c) for c in contents])
+            contents = contents.translate(SUBSTITUTIONS_TABLE)
 
         coords = pdftypes.resolve1(pa.get('QuadPoints'))
         rect = pdftypes.resolve1(pa.get('Rect'))
@@ -310,41 +392,136 @@ def get_outlines(doc, pageslist, pagesdict):
     return result
 
 
-def process_file(fh, pagerange, emit_progress):
-    rsrcmgr = PDFResourceManager()
+def extract_pages(pdfpages, emit_progress, subtypes=ANNOT_SUBTYPES):
+    """
+    Extract the annotations (and their text) from the given (pageno, PDFPage)
+    pairs, considering only annotations of the given subtypes.
+
+    Returns a list of (pageno, annots) pairs in page order. The annotations
+    are detached from their Page object, so that the result can be sent
+    back from a worker process; the caller must reattach them.
+    """
+    # cache fonts and CMaps across pages (pdfminer keys the cache by object
+    # ID, so it must not be shared between documents)
+    rsrcmgr = PDFResourceManager(caching=True)
+    # Note: keep pdfminer's advanced layout analysis (boxes_flow), even though
+    # it is expensive: text is captured in text box order, and only the
+    # hierarchical grouping puts multi-column text boxes in reading order.
     laparams = LAParams()
     device = RectExtractor(rsrcmgr, laparams=laparams)
     interpreter = PDFPageInterpreter(rsrcmgr, device)
+
+    result = []
+
+    for (pageno, pdfpage) in pdfpages:
+        # emit progress indicator
+        if emit_progress:
+            sys.stderr.write((" " if pageno > 0 else "") + "%d" % (pageno + 1))
+            sys.stderr.flush()
+
+        pdfannots = []
+        for a in pdftypes.resolve1(pdfpage.annots):
+            if isinstance(a, pdftypes.PDFObjRef):
+                pdfannots.append(a.resolve())
+            else:
+                sys.stderr.write('Warning: unknown annotation: %s\n' % a)
+
+        page = Page(pageno, pdfpage.mediabox)
+        page.annots = getannots(pdfannots, page, subtypes)
+
+        # Laying out the page is by far the most expensive step, so skip it
+        # if no annotation has boxes that could capture text (e.g. if all are
+        # Text annotations, which are only comments).
+        if any(a.boxes for a in page.annots):
+            device.setannots(page.annots)
+            interpreter.process_page(pdfpage)
+
+        # drop the back-reference, the caller owns the real Page object
+        for a in page.annots:
+            a.page = None
+        result.append((pageno, page.annots))
+
+    device.close()
+    return result
+
+def extract_pages_from_path(path, pagenos, emit_progress, subtypes):
+    """
+    Worker process entry point: open path, find the given page numbers (in
+    ascending order) and call extract_pages() on them.
+    """
+    def selectpages(doc):
+        wanted = iter(pagenos)
+        nextpage = next(wanted)
+        for (pageno, pdfpage) in enumerate(PDFPage.create_pages(doc)):
+            if pageno == nextpage:
+                yield (pageno, pdfpage)
+                nextpage = next(wanted, None)
+                if nextpage is None:
+                    return
+
+    with open(path, 'rb') as fh:
+        doc = PDFDocument(PDFParser(fh))
+        return extract_pages(selectpages(doc), emit_progress, subtypes)
+
+def process_file(fh, pagerange, emit_progress, subtypes=ANNOT_SUBTYPES):
     parser = PDFParser(fh)
     doc = PDFDocument(parser)
 
-    pageslist = [] # pages in page order
+    pageslist = [] # all pages in page order
     pagesdict = {} # map from PDF page object ID to Page object
+    pagesbyno = {} # map from page number to Page object, for selected pages with annotations
+    pdfpages = [] # (page number, PDFPage) for selected pages with annotations
     allannots = []
 
+    # Record every page, even those outside the page range, since outlines
+    # may refer to any of them (by object ID or page index).
     for (pageno, pdfpage) in enumerate(PDFPage.create_pages(doc)):
-        if pagerange != [] and (pageno + 1) not in pagerange: continue
         page = Page(pageno, pdfpage.mediabox)
         pageslist.append(page)
         pagesdict[pdfpage.pageid] = page
-        if pdfpage.annots:
-            # emit progress indicator
-            if emit_progress:
+        if pdfpage.annots and (pagerange == [] or (pageno + 1) in pagerange):
+            pagesbyno[pageno] = page
+            pdfpages.append((pageno, pdfpage))
+
+    # Layout analysis is CPU-bound and independent for each page, so farm it
+    # out to worker processes, each of which opens its own copy of the file
+    # (and so must find its pages again). Pages are dealt round-robin, since
+    # annotations tend to cluster. Otherwise, reuse the pages found above.
+    pagenos = sorted(pagesbyno)
+    path = getattr(fh, 'name', None)
+    if hasattr(os, 'sched_getaffinity'):
+        ncpus = len(os.sched_getaffinity(0)) # respects affinity/cgroup CPU sets
+    else:
+        ncpus = os.cpu_count() or 1
+    nworkers = min(ncpus, len(pagenos))
+    if (nworkers > 1 and len(pagenos) >= MIN_PARALLEL_PAGES
+            and isinstance(path, str) and os.path.isfile(path)):
+        chunks = [pagenos[i::nworkers] for i in range(nworkers)]
+        with concurrent.futures.ProcessPoolExecutor(max_workers=nworkers) as executor:
+            results = [r for chunk in executor.map(extract_pages_from_path,
+                                                   [path] * nworkers, chunks,
+                                                   [False] * nworkers,
+                                                   [subtypes] * nworkers)
+                       for r in chunk]
+        results.sort(key=lambda r: r[0])
+
+        # the workers' progress output would interleave, so report it here
+        if emit_progress:
+            for (pageno, _) in results:
                 sys.stderr.write((" " if pageno > 0 else "") + "%d" % (pageno + 1))
-                sys.stderr.flush()
-
-            pdfannots = []
-            for a in pdftypes.resolve1(pdfpage.annots):
-                if isinstance(a, pdftypes.PDFObjRef):
-                    pdfannots.append(a.resolve())
-                else:
-                    sys.stderr.write('Warning: unknown annotation: %s\n' % a)
+            sys.stderr.flush()
+    elif pagenos:
+        results = extract_pages(pdfpages, emit_progress, subtypes)
+    else:
+        results = []
 
-            page.annots = getannots(pdfannots, page)
-            page.annots.sort()
-            device.setannots(page.annots)
-            interpreter.process_page(pdfpage)
-            allannots.extend(page.annots)
+    for (pageno, annots) in results:
+        page = pagesbyno[pageno]
+        for a in annots:
+            a.page = page
+        page.annots = annots
+        page.annots.sort()
+        allannots.extend(page.annots)
 
     if emit_progress:
         sys.stderr.write("\n")
@@ -358,8 +535,6 @@ def process_file(fh, pagerange, emit_progress):
     except Exception as ex:
         sys.stderr.write("Warning: failed to retrieve outlines: %s\n" % ex)
 
-    device.close()
-
     return (allannots, outlines)
 
 class PrettyPrinter:
@@ -371,7 +546,13 @@ class PrettyPrinter:
         outlines List of outlines
         wrapcol  If not None, specifies the column at which output is word-wrapped
         """
-        self.outlines = outlines
+        # outlines in position order, with their positions, for nearest_outline()
+        try:
+            self.outlines = sorted(outlines, key=lambda o: o.pos)
+        except Exception as ex:
+            sys.stderr.write("Warning: failed to sort outlines, ignoring them: %s\n" % ex)
+            self.outlines = []
+        self.outline_positions = [o.pos for o in self.outlines]
         self.wrapcol = wrapcol
 
         self.BULLET_INDENT1 = " * "
@@ -396,14 +577,10 @@ class PrettyPrinter:
                 initial_indent=self.QUOTE_INDENT,
                 subsequent_indent=self.QUOTE_INDENT)
 
+    # find the last outline preceding pos (if any)
     def nearest_outline(self, pos):
-        prev = None
-        for o in self.outlines:
-            if o.pos < pos:
-                prev = o
-            else:
-                break
-        return prev
+        i = bisect.bisect_left(self.outline_positions, pos)
+        return self.outlines[i - 1] if i > 0 else None
 
     def format_pos(self, annot):
         apos = annot.getstartpos()
@@ -413,7 +590,7 @@ class PrettyPrinter:
         else:
             return "Page %d" % (annot.page.pageno + 1)
 
-    # format a Markdown bullet, wrapped as desired
+    # format a Markdown bullet, wrapped as desired, yielding it in chunks
     def format_bullet(self, paras, quotepos=None, quotelen=None):
         # quotepos/quotelen specify the first paragraph (if any) to be formatted
         # as a block-quote, and the length of the blockquote in paragraphs
@@ -424,9 +601,10 @@ class PrettyPrinter:
 
         # emit the first paragraph with the bullet
         if self.wrapcol:
-            ret = self.bullet_tw1.fill(paras[0])
+            yield self.bullet_tw1.fill(paras[0])
         else:
-            ret = self.BULLET_INDENT1 + paras[0]
+            yield self.BULLET_INDENT1
+            yield paras[0]
 
         # emit subsequent paragraphs
         npara = 1
@@ -436,19 +614,18 @@ class PrettyPrinter:
 
             # emit a paragraph break
             # if we're going straight to a quote, we don't need an extra newline
-            ret = ret + ('\n' if npara == quotepos else '\n\n')
+            yield '\n' if npara == quotepos else '\n\n'
 
             if self.wrapcol:
                 tw = self.quote_tw if inquote else self.bullet_tw2
-                ret = ret + tw.fill(para)
+                yield tw.fill(para)
             else:
-                indent = self.QUOTE_INDENT if inquote else self.BULLET_INDENT2
-                ret = ret + indent + para
+                yield self.QUOTE_INDENT if inquote else self.BULLET_INDENT2
+                yield para
 
             npara += 1
 
-        return ret
-
+    # format an annotation, yielding it in chunks
     def format_annot(self, annot, extra=None):
         # capture item text and contents (i.e. the comment), and split each into paragraphs
         rawtext = annot.gettext()
@@ -472,13 +649,13 @@ class PrettyPrinter:
             msg = label + ' "' + text[0] + '"'
             if comment:
                 msg = msg + ' -- ' + comment[0]
-            return self.format_bullet([msg]) + "\n"
+            yield from self.format_bullet([msg])
 
         # If there is no text and a single-paragraph comment, it also goes on
         # one line.
         elif comment and not text and len(comment) == 1:
             msg = label + " " + comment[0]
-            return self.format_bullet([msg]) + "\n"
+            yield from self.format_bullet([msg])
 
         # Otherwise, text (if any) turns into a blockquote, and the comment (if
         # any) into subsequent paragraphs.
@@ -486,25 +663,35 @@ class PrettyPrinter:
             msgparas = [label] + text + comment
             quotepos = 1 if text else None
             quotelen = len(text) if text else None
-            return self.format_bullet(msgparas, quotepos, quotelen) + "\n"
+            yield from self.format_bullet(msgparas, quotepos, quotelen)
+
+        yield "\n"
+
+    # write a formatted annotation, followed by a blank line
+    def write_annot(self, annot, outfile, extra=None):
+        outfile.writelines(self.format_annot(annot, extra))
+        outfile.write("\n")
 
     def printall(self, annots, outfile):
         for a in annots:
             #to-do: add underline to underline subtype
-            print(self.format_annot(a, a.tagname), file=outfile)
+            self.write_annot(a, outfile, a.tagname)
 
     def printall_grouped(self, subtypes, tags, annots, outfile):
 
         self._printheader_called = False
 
+        # a repeated tag would otherwise print its annotations repeatedly
+        tags = list(dict.fromkeys(tags))
+
         def printheader(header, h_level=1):
             # emit blank separator line if needed
             if self._printheader_called:
-                print("", file=outfile)
+                outfile.write("\n")
             else:
                 self._printheader_called = True
             header = header.title()
-            print("{} {}\n".format("#"*h_level, header), file=outfile)
+            outfile.write("{} {}\n\n".format("#"*h_level, header))
 
         
         #categorizing
@@ -517,22 +704,35 @@ class PrettyPrinter:
                 #here, which creates a new dictionary where every item in seq will
                 #map to the same optional argument value. So change one will result in changing all.
                 annots_categorized[subtype]['untagged'] = [] #for storing annotations without a tag. 
+
+            # find all the tags in an annotation's contents: if available, an
+            # Aho-Corasick automaton does this in one scan regardless of the
+            # number of tags, otherwise search for each tag in turn
+            if ahocorasick is not None and all(tags):
+                automaton = ahocorasick.Automaton()
+                for tag in tags:
+                    automaton.add_word(tag, tag)
+                automaton.make_automaton()
+
+                def findtags(contents):
+                    return {tag for (_, tag) in automaton.iter(contents)}
+            else:
+                def findtags(contents):
+                    return [tag for tag in tags if tag in contents]
+
             for a in annots:
-                for subtype in subtypes:
-                    flag = 0 #for counting how many times an element misses tags
-                    for tag in tags:
-                        if a.contents is not None and a.tagname == subtype and tag in a.contents:
-                            annots_categorized[subtype][tag].append(a)
-                        else:
-                            flag += 1
-                    #if this element misses all tags, it will be added to the 'untagged' list:
-                    if flag == len(tags) and a.tagname == subtype: 
-                        annots_categorized[subtype]['untagged'].append(a)
+                if a.tagname not in annots_categorized: continue
+                categories = annots_categorized[a.tagname]
+                found = findtags(a.contents) if a.contents is not None else ()
+                for tag in found:
+                    categories[tag].append(a)
+                #if this element misses all tags, it will be added to the 'untagged' list:
+                if not found:
+                    categories['untagged'].append(a)
         else:
             for a in annots:
-                for subtype in subtypes:
-                    if a.tagname == subtype:
-                        annots_categorized[subtype].append(a)
+                if a.tagname in annots_categorized:
+                    annots_categorized[a.tagname].append(a)
         
         #printing
         for subtype in subtypes:
@@ -543,14 +743,14 @@ class PrettyPrinter:
                     printheader(tag.replace('**', ''), 2)
                     for a in annots_categorized[subtype][tag]:
                         a.contents = a.contents.replace(tag, '')
-                        print(self.format_annot(a), file=outfile)
+                        self.write_annot(a, outfile)
                 if annots_categorized[subtype]['untagged'] != []: 
                     printheader("untagged", 2)
                     for a in annots_categorized[subtype]['untagged']:
-                            print(self.format_annot(a), file=outfile)
+                            self.write_annot(a, outfile)
             else:
                 for a in annots_categorized[subtype]:
-                    print(self.format_annot(a), file=outfile)
+                    self.write_annot(a, outfile)
 
     def dumping(self, subtypes, tags, annots, outfile):
         pass
@@ -611,7 +811,9 @@ def main():
         else:
             pagerange = []
 
-        (annots, outlines) = process_file(file, pagerange, args.progress)
+        # grouped output only includes the chosen subtypes, so don't extract others
+        subtypes = frozenset(args.subtypes) if args.group else ANNOT_SUBTYPES
+        (annots, outlines) = process_file(file, pagerange, args.progress, subtypes)
 
         pp = PrettyPrinter(outlines, args.wrap)
 